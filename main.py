@@ -1,17 +1,47 @@
 import streamlit as st
 import re
+import asyncio
+import queue
+import threading
+import time
+import json
+import concurrent.futures
 import google.generativeai as genai
 from pptx import Presentation
+from pptx.oxml.ns import qn
 from io import BytesIO
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 # --- CONSTANTS ---
 # 'gemini-1.5-flash' is the stable tag for the latest Flash model in the Python SDK
 MODEL_NAME = "gemini-flash-latest" 
-SEPARATOR = "@@@_START_SLIDE_CONTENT_@@@"
+# In per-slide mode, Generator requests carry this many slides each and are sent concurrently
+SLIDES_PER_CHUNK = 1
+# At most this many Generator requests stream at once, to stay inside Gemini's per-key rate limits
+MAX_CONCURRENT_REQUESTS = 4
+# Otherwise slides are packed into requests of at most this many estimated tokens (chars / 4). Gemini's context
+# window is far larger, but each request's reply has to fit in the model's output token limit
+CHUNK_TOKEN_BUDGET = 6000
+# Instructions that only touch wording slide by slide don't need the rest of the deck in the prompt
+_PER_SLIDE_RE = re.compile(r"\b(translat|tone|grammar|spelling|typo|proofread|rephrase|reword|capitali[sz]|shorten|simplif|format)", re.IGNORECASE)
+# Recovers "pid<TAB>text" lines when the model echoes the input format instead of JSON
+_LINE_RE = re.compile(r"^[ \t]*(\d+)\t(.*)$", re.MULTILINE)
+# Chat chunks are coalesced until this many characters or seconds have built up before re-rendering
+STREAM_FLUSH_CHARS = 24
+STREAM_FLUSH_SECONDS = 0.05
+# Clark-notation tags for walking text bodies directly with lxml
+_A_P = qn("a:p")
+_A_R = qn("a:r")
+_A_T = qn("a:t")
+_ANY_A_T = ".//" + _A_T
 
 # --- CSS & AESTHETICS ---
-def inject_derek_central_css():
-    st.markdown("""
+CSS_STRING = """
     <style>
     /* 1. RESET & FONTS */
     @import url('https://fonts.googleapis.com/css2?family=Satoshi:wght@400;500;700&display=swap');
@@ -139,55 +169,104 @@ def inject_derek_central_css():
     header {visibility: hidden;}
     footer {visibility: hidden;}
     </style>
-    """, unsafe_allow_html=True)
+    """
+
+# Streamlit drops any element a rerun doesn't re-emit, so the style block has to go out on every run
+def inject_derek_central_css():
+    st.markdown(CSS_STRING, unsafe_allow_html=True)
 
 # --- BACKEND LOGIC ---
-def extract_content(pptx_file):
+# Keyed on the file bytes, so re-uploading a deck (or any rerun) skips the lxml parse.
+# Only picklable data is cached; the Generator rebuilds a Presentation from the bytes.
+@st.cache_data(show_spinner=False, max_entries=16, ttl=3600)
+def extract_content(file_bytes):
     try:
-        prs = Presentation(pptx_file)
+        prs = Presentation(BytesIO(file_bytes))
         extracted_lines = []
+        # Repeated paragraphs (footers, section titles...) are sent to the Generator once and the edit is broadcast
+        unique_texts = {}
+        # Estimated Generator payload tokens per slide, used to partition requests under CHUNK_TOKEN_BUDGET
+        slide_tokens = {}
         for s_idx, slide in enumerate(prs.slides):
-            for sh_idx, shape in enumerate(slide.shapes):
+            shapes = slide.shapes
+            for sh_idx, shape in enumerate(shapes):
                 if not shape.has_text_frame: continue
-                for p_idx, paragraph in enumerate(shape.text_frame.paragraphs):
-                    text = "".join(run.text for run in paragraph.runs).strip()
+                # Empty placeholders have a txBody without a single <a:t>; skip them before walking paragraphs
+                txBody = shape._element.txBody
+                if txBody is None or txBody.find(_ANY_A_T) is None: continue
+                for p_idx, p_elem in enumerate(txBody.iterchildren(_A_P)):
+                    text = "".join([r.findtext(_A_T) or "" for r in p_elem.iterchildren(_A_R)]).strip()
                     if text:
-                        extracted_lines.append(f"{{S{s_idx}:Sh{sh_idx}:P{p_idx}}} || {text}")
-        return prs, "\n".join(extracted_lines)
+                        extracted_lines.append("{S%d:Sh%d:P%d} || %s" % (s_idx, sh_idx, p_idx, text))
+                        if text not in unique_texts:
+                            unique_texts[text] = []
+                            slide_tokens[s_idx] = slide_tokens.get(s_idx, 0) + (len(text) + 8) // 4
+                        unique_texts[text].append((s_idx, sh_idx, p_idx))
+        return True, "\n".join(extracted_lines), unique_texts, slide_tokens
     except Exception as e:
-        return None, str(e)
-
-def apply_changes(prs, modified_text):
-    updates = {}
-    for line in modified_text.split('\n'):
-        match = re.search(r"(\{S\d+:Sh\d+:P\d+\})\s*\|\|\s*(.*)", line)
-        if match:
-            uid = match.group(1)
-            new_text = match.group(2).strip()
-            parts = uid.strip("{}").split(":")
-            try:
-                s_idx = int(parts[0][1:])
-                sh_idx = int(parts[1][2:])
-                p_idx = int(parts[2][1:])
-                updates[(s_idx, sh_idx, p_idx)] = new_text
-            except:
-                continue
-
-    for s_idx, slide in enumerate(prs.slides):
-        for sh_idx, shape in enumerate(slide.shapes):
+        return False, str(e), {}, {}
+
+def parse_update_line(line):
+    # Parses one {"id": pid, "text": "..."} JSON line, returns (pid, text) or None
+    line = line.strip()
+    if not line.startswith("{"): return None
+    try:
+        obj = _json_loads(line)
+        pid = obj["id"]
+        new_text = obj["text"]
+    except (ValueError, KeyError, TypeError):
+        return None
+    if isinstance(pid, str) and pid.isdecimal(): pid = int(pid)
+    if type(pid) is not int or not isinstance(new_text, str): return None
+    return pid, new_text.strip()
+
+def stash_update(line, updates):
+    parsed = parse_update_line(line)
+    if parsed:
+        key, new_text = parsed
+        updates[key] = new_text
+        return True
+    return False
+
+def expand_updates(updates, unique_texts):
+    # Maps each pid edit back to every (s, sh, p) paragraph sharing that text
+    pid_to_keys = list(unique_texts.values())
+    expanded = {}
+    for pid, new_text in updates.items():
+        if not 0 <= pid < len(pid_to_keys): continue
+        for key in pid_to_keys[pid]:
+            expanded[key] = new_text
+    return expanded
+
+def apply_changes(prs, updates):
+    # Resolve only the updated paragraphs instead of re-walking the whole deck
+    slides = prs.slides
+    slide_shapes = {}
+    for (s_idx, sh_idx, p_idx), new_text in updates.items():
+        try:
+            if s_idx not in slide_shapes:
+                slide_shapes[s_idx] = list(slides[s_idx].shapes)
+            shape = slide_shapes[s_idx][sh_idx]
             if not shape.has_text_frame: continue
-            for p_idx, paragraph in enumerate(shape.text_frame.paragraphs):
-                key = (s_idx, sh_idx, p_idx)
-                if key in updates:
-                    new_text = updates[key]
-                    if len(paragraph.runs) > 0:
-                        paragraph.runs[0].text = new_text
-                        for i in range(1, len(paragraph.runs)):
-                            paragraph.runs[i].text = ""
-                    else:
-                        paragraph.add_run().text = new_text
+            paragraph = shape.text_frame.paragraphs[p_idx]
+        except IndexError:
+            continue
+
+        p_elem = paragraph._p
+        r_lst = p_elem.r_lst
+        if r_lst:
+            for r in r_lst[1:]:
+                p_elem.remove(r)
+            paragraph.runs[0].text = new_text
+        else:
+            paragraph.add_run().text = new_text
     return prs
 
+def save_presentation(prs):
+    out = BytesIO()
+    prs.save(out)
+    return out.getvalue()
+
 def render_status_spinner(text, color_hex):
     return f"""
         <div style="display: flex; align-items: center; justify-content: center; padding: 20px; 
@@ -197,10 +276,48 @@ def render_status_spinner(text, color_hex):
         </div>
     """
 
+@st.cache_resource
+def get_event_loop():
+    # One long-lived loop shared across reruns, so the async Gemini client isn't rebuilt on a fresh loop every time
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
 def get_gemini_model(api_key):
     genai.configure(api_key=api_key)
     return genai.GenerativeModel(MODEL_NAME)
 
+def run_in_background(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+def iterate_in_background(async_gen):
+    # Drain an async generator on the background loop and hand its items back through a queue
+    items = queue.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for item in async_gen:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+        finally:
+            items.put(done)
+
+    future = run_in_background(pump())
+    try:
+        while (item := items.get()) is not done:
+            if isinstance(item, Exception): raise item
+            yield item
+    finally:
+        # Stop streaming if the consumer goes away (Stop button, rerun) instead of draining the reply into nowhere
+        future.cancel()
+
+async def stream_gemini_chat(full_input, model):
+    response = await model.generate_content_async(full_input, stream=True)
+    async for chunk in response:
+        yield chunk.text
+
 def stream_with_initial_loader(context_prompt, placeholder_obj, api_key):
     placeholder_obj.markdown(
         render_status_spinner("Connecting to Gemini Flash Latest...", "#f1c40f"), 
@@ -208,8 +325,6 @@ def stream_with_initial_loader(context_prompt, placeholder_obj, api_key):
     )
     
     try:
-        model = get_gemini_model(api_key)
-        
         sys_prompt2 = (
             "You are a Professional Presentation Architect communicates clearly, gives examples and guides the user but ultimately listens to their directives. \n"
             "NOTE: Please remain grounded, impartial, realistic and accurate and remember the user does not see the internal pptx positional information. Only you do. Keep track of any connstraitns, requirements, preferences, specifications, etc forever. \n"
@@ -219,17 +334,22 @@ def stream_with_initial_loader(context_prompt, placeholder_obj, api_key):
         )
         
         full_input = f"{sys_prompt2}\n\nUSER QUERY & CONTEXT:\n{context_prompt}"
-        response = model.generate_content(full_input, stream=True)
-        
         has_started = False
+        buf, t0 = "", time.monotonic()
         
-        for chunk in response:
+        for text in iterate_in_background(stream_gemini_chat(full_input, get_gemini_model(api_key))):
             if not has_started:
                 placeholder_obj.empty()
                 has_started = True
             
-            if chunk.text:
-                yield chunk.text
+            if text:
+                buf += text
+                if len(buf) >= STREAM_FLUSH_CHARS or time.monotonic() - t0 > STREAM_FLUSH_SECONDS:
+                    yield buf
+                    buf, t0 = "", time.monotonic()
+        
+        if buf:
+            yield buf
             
         if not has_started:
             placeholder_obj.error("Model returned no response.")
@@ -237,6 +357,75 @@ def stream_with_initial_loader(context_prompt, placeholder_obj, api_key):
     except Exception as e:
         placeholder_obj.error(f"Connection Error: {str(e)}")
 
+def chunk_unique_texts(unique_texts, slide_tokens, slides_per_chunk=None, token_budget=CHUNK_TOKEN_BUDGET):
+    # Each unique text is sent once, with the slide it first appears on. Slides are packed into chunks of
+    # slides_per_chunk slides, or as many as fit in token_budget when slides_per_chunk is None
+    slides = {}
+    for pid, (text, keys) in enumerate(unique_texts.items()):
+        s_idx = keys[0][0]
+        if s_idx not in slides:
+            slides[s_idx] = ["# Slide %d" % (s_idx + 1)]
+        # Compact "pid<TAB>text" lines; the pid indexes unique_texts, which stays in session state
+        slides[s_idx].append("%d\t%s" % (pid, text))
+
+    chunks = []
+    current, count, used = [], 0, 0
+    for s_idx, lines in slides.items():
+        cost = slide_tokens.get(s_idx, 0)
+        if current and (count == slides_per_chunk or used + cost > token_budget):
+            chunks.append("\n".join(current))
+            current, count, used = [], 0, 0
+        current.extend(lines)
+        count += 1
+        used += cost
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def build_generator_prompt(instruction, slides_text):
+    # STRICTER PROMPT
+    sys_prompt = (
+        "You are a Professional Presentation Architect. \n"
+        "NOTE: Please remain grounded, impartial, realistic and accurate and remember the user does not seet the internal pptx positional information. Only you do. Keep track of any connstraitns, requirements, preferences, specifications, etc forever. \n"
+        "1. PLAN: Think, reason and plan the changes silently. Consider what the user wants, the best way to achieve it along with the best way to get there. Also consider what is already in the slide. Do not write the plan out.\n"
+        '2. OUTPUT: Emit one JSON object per line for every paragraph you change, e.g. {"id": 0, "text": "New text"}. No prose, headings or code fences before or after.\n'
+        "Each slide data line is an id, a tab, then the text. The id is that leading number. Do not change IDs. Only change the text, never the id."
+    )
+    return f"SYSTEM INSTRUCTIONS:\n{sys_prompt}\n\nUSER REQUEST: {instruction}\n\nSLIDE DATA:\n{slides_text}"
+
+async def generate_chunk(model, prompt, updates):
+    response = await model.generate_content_async(prompt, stream=True)
+
+    pending = ""
+    rejected = []
+
+    def consume(line):
+        if not stash_update(line, updates) and line.strip():
+            rejected.append(line)
+
+    async for chunk in response:
+        if not chunk.text: continue
+        pending += chunk.text
+
+        # Stash each completed line as it arrives instead of buffering the whole answer
+        while "\n" in pending:
+            line, pending = pending.split("\n", 1)
+            consume(line)
+
+    consume(pending)
+    return rejected
+
+async def run_generator(instruction, chunks, model, updates):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def limited(chunk):
+        async with semaphore:
+            return await generate_chunk(model, build_generator_prompt(instruction, chunk), updates)
+
+    tasks = [limited(chunk) for chunk in chunks]
+    # A failed batch (rate limit, safety block, timeout) comes back as its exception so the others still apply
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
 # --- MAIN APP INIT ---
 st.set_page_config(page_title="Vixip Studio", layout="wide", initial_sidebar_state="collapsed")
 inject_derek_central_css()
@@ -255,6 +444,9 @@ if "raw_pptx_text" not in st.session_state: st.session_state["raw_pptx_text"] =
 if "generator_instruction" not in st.session_state: st.session_state["generator_instruction"] = ""
 if "file_uploaded" not in st.session_state: st.session_state["file_uploaded"] = False
 if "api_key" not in st.session_state: st.session_state["api_key"] = ""
+if "prs_bytes" not in st.session_state: st.session_state["prs_bytes"] = b""
+if "unique_texts" not in st.session_state: st.session_state["unique_texts"] = {}
+if "slide_tokens" not in st.session_state: st.session_state["slide_tokens"] = {}
 
 # --- STEP 1: UPLOAD SECTION ---
 if not st.session_state["file_uploaded"]:
@@ -262,12 +454,13 @@ if not st.session_state["file_uploaded"]:
     uploaded_file = st.file_uploader("Upload PPTX", type="pptx", label_visibility="collapsed")
     
     if uploaded_file:
-        with open("temp.pptx", "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        
-        prs, text = extract_content("temp.pptx")
-        if prs:
+        file_bytes = uploaded_file.getvalue()
+        ok, text, unique_texts, slide_tokens = extract_content(file_bytes)
+        if ok:
             st.session_state["raw_pptx_text"] = text
+            st.session_state["unique_texts"] = unique_texts
+            st.session_state["slide_tokens"] = slide_tokens
+            st.session_state["prs_bytes"] = file_bytes
             st.session_state["file_uploaded"] = True
             st.rerun()
 
@@ -290,6 +483,9 @@ elif st.session_state["file_uploaded"] and not st.session_state["api_key"]:
     if st.button("⬅️ Upload Different File"):
         st.session_state["file_uploaded"] = False
         st.session_state["raw_pptx_text"] = ""
+        st.session_state["prs_bytes"] = b""
+        st.session_state["unique_texts"] = {}
+        st.session_state["slide_tokens"] = {}
         st.rerun()
 
 # --- STEP 3: MAIN INTERFACE (Unlocked) ---
@@ -303,7 +499,14 @@ else:
         if st.button("Upload New File"):
             st.session_state["file_uploaded"] = False
             st.session_state["raw_pptx_text"] = ""
+            st.session_state["prs_bytes"] = b""
+            st.session_state["unique_texts"] = {}
+            st.session_state["slide_tokens"] = {}
             st.rerun()
+        st.caption(
+            f"With \"Edit each slide independently\" on, the Generator sends one request per slide, {MAX_CONCURRENT_REQUESTS} at a time. "
+            "If you hit Gemini rate limits (HTTP 429) on large decks, turn that option off to send fewer, larger requests."
+        )
 
     tab_chat, tab_gen = st.tabs(["Chat & Strategy", "Slide Generator"])
 
@@ -351,6 +554,20 @@ else:
             height=150
         )
         
+        # Seed the checkbox from the instruction, but only move it while the user hasn't overridden the suggestion
+        suggested = bool(_PER_SLIDE_RE.search(instruction))
+        if "per_slide" not in st.session_state:
+            st.session_state["per_slide"] = suggested
+        elif st.session_state["per_slide"] == st.session_state["per_slide_suggested"]:
+            st.session_state["per_slide"] = suggested
+        st.session_state["per_slide_suggested"] = suggested
+        
+        per_slide = st.checkbox(
+            "Edit each slide independently",
+            key="per_slide",
+            help="Faster for translation, tone and formatting changes. Turn off for deck-wide rewrites that need many slides in view (large decks are still split to fit the model's limits)."
+        )
+        
         col1, col2 = st.columns([1, 4])
         with col1:
             run_btn = st.button("Run Transformation", type="primary", use_container_width=True)
@@ -361,65 +578,57 @@ else:
             else:
                 status_box = st.empty()
                 
-                # STRICTER PROMPT
-                sys_prompt = (
-                    "You are a Professional Presentation Architect. \n"
-                    "NOTE: Please remain grounded, impartial, realistic and accurate and remember the user does not seet the internal pptx positional information. Only you do. Keep track of any connstraitns, requirements, preferences, specifications, etc forever. \n"
-                    "1. PLAN: First, think, reason and plan the changes. Consider what the user wants, the best way to achieve it along with the best way to get there. Also consider what is already in the slide. Think, reason, plan, draft and consider multiple possibilities given the prior then tackle the whole thing.\n"
-                    f"2. SEPARATOR: When ready to output code, you MUST output this line: {SEPARATOR} ENSURE YOU USE {SEPARATOR} otherwise the content might not be parsed!\n"
-                    "3. OUTPUT: After that line, write the modified lines in format {S#:Sh#:P#} || Text\n"
-                    "Do not change IDs and when discussing slides do not mention them since the user does not see the {S1:Sh2:P0} || they only see the stuff after the ||. Only change the text not anything before the ||."
-                )
-                full_prompt = f"SYSTEM INSTRUCTIONS:\n{sys_prompt}\n\nUSER REQUEST: {instruction}\n\nSLIDE DATA:\n{st.session_state['raw_pptx_text']}"
-                
                 try:
                     status_box.markdown(render_status_spinner("Initializing Gemini Agent...", "#f1c40f"), unsafe_allow_html=True)
                     
-                    model = get_gemini_model(st.session_state["api_key"])
-                    response = model.generate_content(full_prompt, stream=True)
+                    unique_texts = st.session_state["unique_texts"]
+                    chunks = chunk_unique_texts(unique_texts, st.session_state["slide_tokens"], SLIDES_PER_CHUNK if per_slide else None)
+                    status_box.markdown(render_status_spinner(f"Working... (Gemini is reasoning over {len(chunks)} batches...)", "#8e44ad"), unsafe_allow_html=True)
                     
-                    status_box.markdown(render_status_spinner("Working... (Gemini is reasoning...)", "#8e44ad"), unsafe_allow_html=True)
+                    total = max(len(unique_texts), 1)
+                    progress_bar = st.progress(0.0, text="Waiting for slide updates...")
                     
-                    thinking_buffer = ""
-                    slide_content = ""
-                    mode = "THINKING"
+                    # The batches run on the background loop; poll from here since only this thread may touch the UI
+                    updates = {}
+                    future = run_in_background(run_generator(instruction, chunks, get_gemini_model(st.session_state["api_key"]), updates))
+                    try:
+                        while not future.done():
+                            concurrent.futures.wait([future], timeout=0.1)
+                            count = len(updates)
+                            progress_bar.progress(min(count / total, 1.0), text=f"{count} of {total} paragraphs updated")
+                        results = future.result()
+                    finally:
+                        # Stop any batches still streaming if this run is interrupted
+                        if not future.done(): future.cancel()
+                        progress_bar.empty()
+                    
+                    failed = [r for r in results if isinstance(r, BaseException)]
+                    results = [r for r in results if not isinstance(r, BaseException)]
+                    if failed:
+                        st.warning(f"{len(failed)} of {len(chunks)} batches failed (first error: {failed[0]}). Edits from the other batches were kept.")
                     
-                    for chunk in response:
-                        if not chunk.text: continue
-                        content = chunk.text
-                        
-                        if mode == "THINKING":
-                            thinking_buffer += content
-                            if SEPARATOR in thinking_buffer:
-                                mode = "WRITING"
-                                status_box.markdown(render_status_spinner("Generating Final Slides...", "#2ecc71"), unsafe_allow_html=True)
-                                
-                                parts = thinking_buffer.split(SEPARATOR)
-                                if len(parts) > 1:
-                                    slide_content += parts[1]
-                        else:
-                            slide_content += content
-
                     # === FAIL-SAFE ===
-                    if mode == "THINKING":
-                        if "{S0" in thinking_buffer or "||" in thinking_buffer:
-                            lines = thinking_buffer.split('\n')
-                            valid_lines = [l for l in lines if "||" in l and "{" in l]
-                            if valid_lines:
-                                slide_content = "\n".join(valid_lines)
-                                st.warning("Model ignored the separator, but slide content was recovered.")
-                            else:
-                                st.error("Model finished but produced no valid slide lines.")
-                        else:
-                            st.error("Model finished but did not generate any slide updates.")
+                    rejected = [line for lines in results for line in lines]
+                    if rejected:
+                        rejected_text = "\n".join(rejected)
+                        recovered = {int(m[1]): m[2].strip() for m in _LINE_RE.finditer(rejected_text)}
+                        for pid, new_text in recovered.items():
+                            updates.setdefault(pid, new_text)
+                        if recovered:
+                            st.warning(f"Model ignored the JSON format, but {len(recovered)} line(s) were recovered.")
+                        with st.expander(f"{len(rejected)} non-JSON line(s) from the model"):
+                            st.code(rejected_text)
+                    if not updates:
+                        st.error("Model finished but did not generate any slide updates.")
                     
                     # FINAL PROCESSING
-                    if slide_content.strip():
-                        prs = Presentation("temp.pptx")
-                        updated = apply_changes(prs, slide_content)
-                        out = BytesIO()
-                        updated.save(out)
-                        out.seek(0)
+                    if updates:
+                        # Fresh copy from the upload bytes so retries never see earlier edits
+                        prs = Presentation(BytesIO(st.session_state["prs_bytes"]))
+                        updated = apply_changes(prs, expand_updates(updates, unique_texts))
+                        
+                        status_box.markdown(render_status_spinner("Packaging your deck...", "#2ecc71"), unsafe_allow_html=True)
+                        out = save_presentation(updated)
                         
                         status_box.empty()
                         st.success("✅ Transformation Complete!")